@@ -1,27 +1,45 @@
-from PIL import Image, ImageOps
+from dataclasses import dataclass
+from PIL import Image
 import argparse
-import itertools
 import json
 import logging
+import math
+import multiprocessing
 import os
+import PIL
 import pathlib
 
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
 APP_NAME         = 'magnet-framer'
-SCRIPT_DIR_PATH  = pathlib.Path(__file__).parent.resolve()
-CONFIG_FILE_PATH = os.path.join(SCRIPT_DIR_PATH, 'config.json')
-LOG_PATH         = os.path.join(SCRIPT_DIR_PATH, f'{APP_NAME}.log')
+SCRIPT_DIR_PATH  = str(pathlib.Path(__file__).resolve().parent)
+CONFIG_FILE_PATH = f'{SCRIPT_DIR_PATH}/config.json'
+LOG_PATH         = f'{SCRIPT_DIR_PATH}/{APP_NAME}.log'
 
-json_config    = None
-config         = None
-current_config = None
+configs  = None
+canvases = None
 
 class Crop:
+    __slots__ = ('left', 'top', 'right', 'bottom')
+
     def __init__(self, left, top, right, bottom):
         self.left   = left
         self.top    = top
         self.right  = right
         self.bottom = bottom
 
+@dataclass(slots=True)
+class CurrentConfig:
+    crop:         Crop
+    scale_factor: float
+    frame_rgb:    Image.Image
+    frame_mask:   Image.Image
+    frame_width:  int
+    frame_height: int
+
 class CustomFormatter(logging.Formatter):
 
     grey         = '\x1b[38;20m'
@@ -40,54 +58,87 @@ class CustomFormatter(logging.Formatter):
         logging.CRITICAL: bold_red     + format + reset,
     }
 
+    def __init__(self):
+        super().__init__()
+        self._formatters = {level: logging.Formatter(log_fmt, datefmt='%H:%M:%S') for level, log_fmt in self.FORMATS.items()}
+
     def format(self, record):
-        log_fmt = self.FORMATS.get(record.levelno)
-        formatter = logging.Formatter(log_fmt, datefmt='%H:%M:%S')
+        formatter = self._formatters.get(record.levelno)
+        if formatter is None:
+            return super().format(record)
         return formatter.format(record)
 
-def crop_image(image):
-    crop = current_config['crop']
-    coordinates = crop.left, crop.top, image.width - crop.right, image.height - crop.bottom
-    cropped_image = image.crop(coordinates)
-
-    return cropped_image
-
-def scale_image(image, frame):
-    scale_factor = current_config['scale-factor']
-    scale_factor = scale_factor * min(frame.width / image.width, frame.height / image.height)
-    new_width  = int(image.width * scale_factor)
-    new_height = int(image.height * scale_factor)
-    scaled_image = image.resize((new_width, new_height))
+def crop_box(image, crop):
+    box = crop.left, crop.top, image.width - crop.right, image.height - crop.bottom
+
+    return box
+
+def scaled_size(box, frame_width, frame_height, scale_factor):
+    cropped_width  = box[2] - box[0]
+    cropped_height = box[3] - box[1]
+    scale_factor = scale_factor * min(frame_width / cropped_width, frame_height / cropped_height)
+    new_width  = int(cropped_width * scale_factor)
+    new_height = int(cropped_height * scale_factor)
+
+    return new_width, new_height
+
+def draft_image(image, box, size):
+    # libjpeg can decode at 1/2, 1/4 or 1/8 scale, ask for the smallest one
+    # that still covers the scaled crop and map the crop box onto the result
+    cropped_width  = box[2] - box[0]
+    cropped_height = box[3] - box[1]
+    requested_size = (math.ceil(image.width * size[0] / cropped_width), math.ceil(image.height * size[1] / cropped_height))
+    original_width = image.width
+    drafted = image.draft('RGB', requested_size)
+    if drafted is None:
+        return box
+    logging.debug(f'Image drafted to size {image.size}')
+    ratio = drafted[1][2] / original_width
+
+    return tuple(coordinate * ratio for coordinate in box)
+
+def crop_and_scale(image, box, size, resize_backend):
+    if resize_backend == 'pillow':
+        # Resizing a box of the source crops and scales in a single pass
+        return image.resize(size, resample=Image.Resampling.BILINEAR, box=box)
+
+    # OpenCV resizes faster, but converting to an array copies the whole image
+    # and the crop is rounded to whole pixels of the (possibly drafted) image
+    left, top, right, bottom = (round(coordinate) for coordinate in box)
+    cropped_array = as_array(image)[top:bottom, left:right]
+    interpolation = cv2.INTER_AREA if size[0] < cropped_array.shape[1] else cv2.INTER_LINEAR
+    scaled_image = from_array(cv2.resize(cropped_array, size, interpolation=interpolation))
 
     return scaled_image
 
-def pad_image(image, frame):
-    horizontal_correction = 0
-    vertical_correction   = 0
-
-    left_padding   = ((frame.width - image.width) // 2) + horizontal_correction
-    top_padding    = ((frame.height - image.height) // 2) + vertical_correction
-    right_padding  = frame.width - image.width - left_padding
-    bottom_padding = frame.height - image.height - top_padding
-
-    padding = (left_padding, top_padding, right_padding, bottom_padding)
+def frame_image(image, canvas, current_config, debug):
+    frame_width  = current_config.frame_width
+    frame_height = current_config.frame_height
+    x = (frame_width - image.width) // 2
+    y = (frame_height - image.height) // 2
 
-    padded_image = ImageOps.expand(image, padding, fill='red' if config.debug else 'white')
+    # The frame-sized canvas doubles as the padding around the image. It is
+    # reused between files and returned as is, so the returned image is only
+    # valid until the next call with the same canvas
+    framed_image = canvas
+    framed_image.paste('red' if debug else 'white', (0, 0, frame_width, frame_height))
+    framed_image.paste(image, (x, y))
+    framed_image.paste(current_config.frame_rgb, (0, 0), current_config.frame_mask)
 
-    return padded_image
-
-def frame_image(image, frame):
-    x = (frame.width - image.width) // 2
-    y = (frame.height - image.height) // 2
+    return framed_image
 
-    framed_image = image.copy()
-    framed_image.paste(frame, (x, y), frame)
-    framed_image = framed_image.convert('RGB')
+# Per-pixel work must go through these helpers instead of getpixel/putpixel,
+# with the pixel loop itself in a @numba.njit(parallel=True) kernel using
+# numba.prange rather than pure Python. numpy is only imported when needed.
+def as_array(image):
+    import numpy as np
+    return np.asarray(image)
 
-    return framed_image
+def from_array(array):
+    return Image.fromarray(array)
 
 def rotate_image(image):
-    rotated_image = image.rotate(90, expand=True)
+    rotated_image = image.transpose(Image.Transpose.ROTATE_90)
 
     return rotated_image
 
@@ -99,101 +150,149 @@ def image_orientation(image):
     else:
         return 'square'
 
-def output_filename_with_postfix(filename, postfix):
-    splitted_filename = os.path.splitext(filename)
-    newFilename = os.path.join(config.output, splitted_filename[0] + postfix + splitted_filename[1])
+def output_filename_with_postfix(output_path, filename, postfix, extension=None):
+    base, original_extension = os.path.splitext(filename)
+    newFilename = f'{output_path}/{base}{postfix}{extension or original_extension}'
     logging.debug(f'generated output filename: {newFilename}')
     return newFilename
 
-def save_image(image, filename, postfix):
-    final_name = output_filename_with_postfix(filename, postfix)
-    image.convert('RGB').save(final_name)
-
-def set_current_config(image):
-    global current_config
-    if image_orientation(image) == 'landscape':
-        current_config = {
-            'frame-path': json_config['land-frame-path'],
-            'crop': Crop(json_config['land-crop-left'], json_config['land-crop-top'], json_config['land-crop-right'], json_config['land-crop-bottom']),
-            'scale-factor': json_config['land-scale-factor'],
-        }
-    elif image_orientation(image) == 'portrait':
-        current_config = {
-            'frame-path': json_config['port-frame-path'],
-            'crop': Crop(json_config['port-crop-left'], json_config['port-crop-top'], json_config['port-crop-right'], json_config['port-crop-bottom']),
-            'scale-factor': json_config['port-scale-factor'],
-        }
+def save_image(image, output_path, filename, postfix, extension=None):
+    final_name = output_filename_with_postfix(output_path, filename, postfix, extension)
+    # PNG keeps the alpha channel, JPEG needs a single conversion to RGB
+    if image.mode == 'RGB' or extension == '.png':
+        image.save(final_name)
     else:
-        logging.error("Can't process square image")
-        exit(1)
-
-def unset_current_config():
-    global current_config
-    current_config = None
-
-def process():
-    for filename in os.listdir(config.input):
-        if filename.endswith('.jpg'):
-            counter = itertools.count(start=0)
-
-            img_path = os.path.join(config.input, filename)
-            logging.info(f'file {img_path} status: processing...')
-
-            original_image = Image.open(img_path).convert('RGBA')
-            logging.debug(f'Image loaded successfully')
-            logging.debug(f'Image size: {original_image.size}')
-            logging.debug(f'Image orientation: {image_orientation(original_image)}')
-            set_current_config(original_image)
-            if config.debug:
-                save_image(original_image, filename, f'_{next(counter)}_original')
-
-            frame = Image.open(current_config['frame-path']).convert('RGBA')
-            logging.debug(f'Frame loaded successfully')
-            logging.debug(f'Frame size: {frame.size}')
-            logging.debug(f'Frame orientation: {image_orientation(frame)}')
-
-            cropped_image = crop_image(original_image)
+        image.convert('RGB').save(final_name)
+
+def build_config(orientation, json_config, frame):
+    # Split the frame once, the canvas is RGB so it is pasted with its alpha as mask
+    frame_width, frame_height = frame.size
+    frame_rgb  = frame.convert('RGB')
+    frame_mask = frame.getchannel('A')
+    if orientation == 'landscape':
+        return CurrentConfig(
+            crop=Crop(json_config['land-crop-left'], json_config['land-crop-top'], json_config['land-crop-right'], json_config['land-crop-bottom']),
+            scale_factor=json_config['land-scale-factor'],
+            frame_rgb=frame_rgb,
+            frame_mask=frame_mask,
+            frame_width=frame_width,
+            frame_height=frame_height,
+        )
+    elif orientation == 'portrait':
+        return CurrentConfig(
+            crop=Crop(json_config['port-crop-left'], json_config['port-crop-top'], json_config['port-crop-right'], json_config['port-crop-bottom']),
+            scale_factor=json_config['port-scale-factor'],
+            frame_rgb=frame_rgb,
+            frame_mask=frame_mask,
+            frame_width=frame_width,
+            frame_height=frame_height,
+        )
+
+def process_one(filename, img_path, config, json_config):
+    debug          = config['debug']
+    output_path    = config['output']
+    resize_backend = config['resize_backend']
+
+    logging.info(f'file {img_path} status: processing...')
+
+    # The context manager releases the input file and its decoded buffer
+    # as soon as the scaled image has been produced
+    with Image.open(img_path) as original_image:
+        orientation = image_orientation(original_image)
+        logging.debug(f'Image size: {original_image.size}')
+        logging.debug(f'Image orientation: {orientation}')
+        if orientation not in configs:
+            raise ValueError(f"Can't process {orientation} image")
+        current_config = configs[orientation]
+
+        box  = crop_box(original_image, current_config.crop)
+        size = scaled_size(box, current_config.frame_width, current_config.frame_height, current_config.scale_factor)
+        # Debug outputs show the full-resolution source, so only draft without them
+        if not debug:
+            box = draft_image(original_image, box, size)
+
+        # JPEGs carry no alpha, only the frame needs it as a paste mask
+        if original_image.mode != 'RGB':
+            original_image = original_image.convert('RGB')
+        logging.debug(f'Image loaded successfully')
+        if debug:
+            save_image(original_image, output_path, filename, '_0_original', '.png')
+
+        if debug:
+            cropped_image = original_image.crop(box)
             logging.debug(f'Image cropped to size {cropped_image.size}')
-            if config.debug:
-                save_image(cropped_image, filename, f'_{next(counter)}_cropped')
-
-            scaled_image = scale_image(cropped_image, frame)
-            logging.debug(f'Image scaled to size {scaled_image.size}')
-            if config.debug:
-                save_image(scaled_image, filename, f'_{next(counter)}_scaled')
-
-            padded_image = pad_image(scaled_image, frame)
-            logging.debug(f'Image padded to size {padded_image.size}')
-            if config.debug:
-                save_image(padded_image, filename, f'_{next(counter)}_padded')
-
-            framed_image = frame_image(padded_image, frame)
-            logging.debug(f'Image framed successfully')
+            save_image(cropped_image, output_path, filename, '_1_cropped', '.png')
+            del cropped_image
+
+        scaled_image = crop_and_scale(original_image, box, size, resize_backend)
+        logging.debug(f'Image scaled to size {scaled_image.size}')
+        if debug:
+            save_image(scaled_image, output_path, filename, '_2_scaled', '.png')
+    del original_image
+
+    framed_image = frame_image(scaled_image, canvases[orientation], current_config, debug)
+    del scaled_image
+    logging.debug(f'Image framed successfully')
+
+    if (json_config['rotate-to-landscape'] and orientation == 'portrait'):
+        final_image = rotate_image(framed_image)
+        del framed_image
+    else:
+        final_image = framed_image
 
-            if (json_config['rotate-to-landscape'] and image_orientation(original_image) == 'portrait'):
-                final_image = rotate_image(framed_image)
-            else:
-                final_image = framed_image
+    save_image(final_image, output_path, filename, '_3_framed' if debug else '_framed')
+    logging.info(f'file {img_path} status: done')
 
-            save_image(final_image, filename, f'_{next(counter)}_framed' if config.debug else '_framed')
-            unset_current_config()
-            logging.info(f'file {img_path} status: done')
+def load_frame(frame_path):
+    with Image.open(frame_path) as frame:
+        return frame.convert('RGBA')
 
-def configure_logging(logLevel):
+def load_frames(json_config):
+    loaded_frames = {
+        'landscape': load_frame(json_config['land-frame-path']),
+        'portrait':  load_frame(json_config['port-frame-path']),
+    }
+    for orientation, frame in loaded_frames.items():
+        logging.debug(f'Frame {orientation} loaded successfully')
+        logging.debug(f'Frame {orientation} size: {frame.size}')
+
+    return loaded_frames
+
+def init_worker(logLevel, loaded_configs):
+    global configs
+    global canvases
+    configure_logging_worker(logLevel)
+    configs = loaded_configs
+    # Every worker process owns its canvases, they must not be shared between threads
+    canvases = {orientation: Image.new('RGB', (current_config.frame_width, current_config.frame_height)) for orientation, current_config in configs.items()}
+
+def process(config, json_config):
+    with os.scandir(config.input) as it:
+        entries = [e for e in it if e.is_file() and e.name.lower().endswith(('.jpg', '.jpeg'))]
+    loaded_configs = {orientation: build_config(orientation, json_config, frame) for orientation, frame in load_frames(json_config).items()}
+    logLevel = logging.getLogger().getEffectiveLevel()
+    with multiprocessing.Pool(os.cpu_count(), initializer=init_worker, initargs=(logLevel, loaded_configs)) as pool:
+        pool.starmap(process_one, [(e.name, e.path, vars(config), json_config) for e in entries], chunksize=1)
+
+def configure_logging(logLevel, truncate=True):
+    # The log file is opened in append mode so the pool workers can share it
+    if truncate:
+        open(LOG_PATH, 'w').close()
     logging.basicConfig(level=logLevel,
                         format='%(asctime)s.%(msecs)03d %(name)-20s %(levelname)-8s %(message)s',
                         datefmt='%Y-%m-%d %H:%M',
                         filename=LOG_PATH,
-                        filemode='w')
+                        filemode='a',
+                        force=True)
     console = logging.StreamHandler()
     formatter = CustomFormatter()
     console.setFormatter(formatter)
     logging.getLogger().addHandler(console)
 
-def configure():
-    global json_config
-    global config
+def configure_logging_worker(logLevel):
+    configure_logging(logLevel, truncate=False)
 
+def configure():
     with open(CONFIG_FILE_PATH, 'r') as f:
         json_config = json.load(f)
 
@@ -204,6 +303,7 @@ def configure():
     parser.add_argument('-l', '--landscape-frame', type=str           , help='Path to landscape frame file'  , default=json_config['land-frame-path'])
     parser.add_argument('-p', '--portrait-frame' , type=str           , help='Path to portrait frame file'   , default=json_config['port-frame-path'])
     parser.add_argument('-d', '--debug'          , action='store_true', help='Run in debug mode'             , default=json_config['debug'])
+    parser.add_argument('-r', '--resize-backend' , choices=['pillow', 'opencv'], help='Library used to resize images', default=json_config['resize-backend'])
 
     config = parser.parse_args()
 
@@ -212,7 +312,19 @@ def configure():
         logLevel = logging.DEBUG
     configure_logging(logLevel)
 
-def verify_input():
+    return config, json_config
+
+def verify_pillow():
+    if 'post' not in PIL.__version__:
+        logging.warning(f'Pillow {PIL.__version__} is not Pillow-SIMD, image processing will be slower')
+
+def verify_resize_backend(config):
+    if config.resize_backend == 'opencv' and cv2 is None:
+        logging.error('Resize backend opencv requested but cv2 is not installed')
+        exit(1)
+    logging.info(f'Resize backend: {config.resize_backend}')
+
+def verify_input(config):
     if(not os.path.isdir(config.input)):
         logging.error(f'Input directory {config.input} does not exist')
         exit(1)
@@ -221,8 +333,14 @@ def verify_input():
         exit(1)
 
 if __name__ == '__main__':
-    configure()
+    config, json_config = configure()
     logging.info(f'--- {APP_NAME} start ---')
-    verify_input()
-    process()
+    verify_pillow()
+    verify_resize_backend(config)
+    verify_input(config)
+    try:
+        process(config, json_config)
+    except ValueError as e:
+        logging.error(e)
+        exit(1)
     logging.info(f'---  {APP_NAME} End  ---')